@@ -17,12 +17,22 @@
 #
 # @@license_version:1.6@@
 
+import binascii
+import errno
+import hashlib
+import mmap
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
+import tempfile
+import time
+import traceback
 import warnings
+from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
+from array import array
 from zipfile import ZipFile
 
 import itertools
@@ -35,14 +45,35 @@ try:
 except ImportError:
     from StringIO import StringIO
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 CURRENT_DIR = os.path.realpath(os.path.dirname(__file__))
 ICON_LIBRARY_PATH = os.path.realpath(os.path.join(CURRENT_DIR, '..', 'res', 'icons.zip'))
+# Set to an empty string to disable the on-disk cache of rendered icons
+ICON_RENDER_CACHE_DIR = os.environ.get('ICON_RENDER_CACHE_DIR',
+                                       os.path.join(os.path.expanduser('~'), '.cache', 'mobicage-build', 'icons'))
+ICON_RENDER_CACHE_MAX_BYTES = int(os.environ.get('ICON_RENDER_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# png.Writer preset used for the recoloured images, e.g. 'fast' for debug builds and 'smallest' for release builds
+ICON_ENCODER_PRESET = os.environ.get('ICON_ENCODER_PRESET') or None
+# Part of the render cache key: change this whenever the rendering or png encoding settings change the output
+if ICON_ENCODER_PRESET:
+    ICON_ENCODER_SETTINGS = 'png.Writer(preset=%s)' % ICON_ENCODER_PRESET
+else:
+    ICON_ENCODER_SETTINGS = 'png.Writer(filter=0, compression=default)'
 
 
 def _create_dir_if_not_exists(path):
     path = os.path.dirname(path)
     if not os.path.exists(path):
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            # Created by a concurrent build or worker in the meantime
+            if e.errno != errno.EEXIST:
+                raise
 
 
 @contextmanager
@@ -53,28 +84,502 @@ def pushd(new_dir):
     os.chdir(prev_dir)
 
 
-def get_icon_from_library(name, size=512):
-    zipf = ZipFile(ICON_LIBRARY_PATH)
+class _MappedFile(object):
+    """Minimal read-only file object on top of an mmap, as required by ZipFile."""
+
+    def __init__(self, mapping):
+        self._mapping = mapping
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = len(self._mapping) - self._mapping.tell()
+        return self._mapping.read(n)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._mapping.seek(offset, whence)
+
+    def tell(self):
+        return self._mapping.tell()
+
+
+class IconLibrary(object):
+    """Long-lived handle on the icon library archive.
+
+    The archive is opened once and its entries are indexed by (name, size), so reading an icon does not re-parse the
+    zip central directory. With `use_mmap` the archive is memory mapped and reads are served from the mapping.
+    """
+
+    def __init__(self, path=ICON_LIBRARY_PATH, use_mmap=True):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = None
+        source = self._file
+        if use_mmap:
+            try:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                source = _MappedFile(self._mmap)
+            except (EnvironmentError, ValueError):
+                # e.g. empty files or file systems that do not support mapping
+                self._mmap = None
+        self._zipf = ZipFile(source)
+        self._index = {}
+        for info in self._zipf.infolist():
+            size, _, filename = info.filename.partition('/')
+            name, ext = os.path.splitext(filename)
+            if ext == '.png' and size.isdigit():
+                self._index[(name, int(size))] = info
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get_info(self, name, size=512):
+        try:
+            return self._index[(name, int(size))]
+        except KeyError:
+            raise KeyError('There is no item named %r in the archive' % ('%s/%s.png' % (size, name)))
+
+    def read(self, name, size=512):
+        return self._zipf.read(self.get_info(name, size))
+
+    def close(self):
+        self._zipf.close()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+
+_icon_library = None
+
+
+def get_icon_library():
+    global _icon_library
+    if _icon_library is None:
+        _icon_library = IconLibrary()
+    return _icon_library
+
+
+def get_icon_from_library(name, size=512, library=None):
+    if library is None:
+        library = get_icon_library()
+    return library.read(name, size)
+
+
+class DecodedIconCache(object):
+    """LRU cache of decoded icon pixels, bounded by the total size in bytes of the cached pixel arrays.
+
+    The hits, misses and evictions counters are kept so the byte budget can be sized for the build hosts.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Re-insert to mark the entry as most recently used
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size_in_bytes):
+        if key in self._entries:
+            self.current_bytes -= self._entries.pop(key)[1]
+        if size_in_bytes > self.max_bytes:
+            return
+        self._entries[key] = (value, size_in_bytes)
+        self.current_bytes += size_in_bytes
+        self._evict()
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes:
+            _, (_, size_in_bytes) = self._entries.popitem(last=False)
+            self.current_bytes -= size_in_bytes
+            self.evictions += 1
+
+
+icon_pixel_cache = DecodedIconCache()
+
+
+def get_decoded_icon(name, size=512, library=None, png_bytes=None, digest=None):
+    """Returns the library icon as (width, height, pixels, metadata), with pixels in flat row flat pixel format.
+
+    The cache is keyed on the sha1 hex `digest` of the icon file (computed when not given), so icons with the same
+    name from different libraries do not share entries. The result is shared with the decoded icon cache and must not
+    be modified.
+    """
+    if png_bytes is None:
+        png_bytes = get_icon_from_library(name, size, library)
+    if digest is None:
+        digest = hashlib.sha1(png_bytes).hexdigest()
+    key = digest
+    decoded = icon_pixel_cache.get(key)
+    if decoded is None:
+        # Library icons are trusted, and ZipFile already verified the CRC of the whole file
+        decoded = _decode_png(png_bytes, checksums='skip')
+        pixels = decoded[2]
+        icon_pixel_cache.put(key, decoded, len(pixels) * pixels.itemsize)
+    return decoded
+
+
+class IconRenderCache(object):
+    """Content-addressed on-disk cache of rendered icons, meant to be shared between (concurrent) builds.
+
+    Entries are keyed by a hash of everything that determines the rendered output. They are written to a temporary
+    file first and then renamed into place, so readers never see partially written icons. When the cache grows beyond
+    `max_bytes`, the least recently used entries are removed.
+    """
+
+    def __init__(self, directory, max_bytes=ICON_RENDER_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size = None
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.sha1()
+        for part in parts:
+            part = str(part)
+            digest.update('%d:' % len(part))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], '%s.png' % key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except EnvironmentError:
+            return None
+        try:
+            # The modification time is used as last access time for the eviction
+            os.utime(path, None)
+        except EnvironmentError:
+            # e.g. an entry written by another user, which can still be read
+            pass
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        _create_dir_if_not_exists(path)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # mkstemp creates the file as 0600, the cache is shared with the builds of other users
+            os.chmod(tmp_path, 0644)
+            try:
+                replaced_size = os.path.getsize(path)
+            except OSError:
+                replaced_size = 0
+            os.rename(tmp_path, path)
+        except:
+            _remove_file(tmp_path)
+            raise
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._list_entries())
+        else:
+            self._size += len(data) - replaced_size
+        if self._size > self.max_bytes:
+            self.prune()
+
+    def prune(self, max_bytes=None):
+        """Removes the least recently used entries until the cache uses at most 90% of `max_bytes`."""
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = sorted(self._list_entries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= max_bytes * 0.9:
+                break
+            _remove_file(path)
+            size -= entry_size
+        self._size = size
+
+    def _list_entries(self):
+        if not os.path.isdir(self.directory):
+            return
+        for dir_path, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if not file_name.endswith('.png'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # Removed by a concurrent build
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+
+def _remove_file(path):
     try:
-        return zipf.read("%s/%s.png" % (size, name))
-    finally:
-        zipf.close()
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
 
 
-def download_icon(icon_key, icon_color, icon_size, file_path):
-    if icon_color:
-        icon_color = str(icon_color).replace("#", "")
+_icon_render_cache = None
+
+
+def get_icon_render_cache():
+    global _icon_render_cache
+    if _icon_render_cache is None and ICON_RENDER_CACHE_DIR:
+        _icon_render_cache = IconRenderCache(ICON_RENDER_CACHE_DIR)
+    return _icon_render_cache
+
+
+def render_icon(icon_key, icon_color, icon_size, library=None, render_cache=None, tolerance=0, tint=False):
+    """Renders a library icon in the given colour, consulting the on-disk render cache first.
+
+    By default the black pixels of the icon are recoloured, see remap_png_colors for `tolerance`. With `tint` the icon
+    is used as an alpha mask instead, see tint_png.
+    """
+    size = icon_size or 50
+    source_color = (0, 0, 0)
+    target_color = parse_color(icon_color)
+    color_map = [(source_color, target_color)]
+    icon_bytes = get_icon_from_library(icon_key, size, library)
+    icon_digest = hashlib.sha1(icon_bytes).hexdigest()
+    if render_cache is None:
+        render_cache = get_icon_render_cache()
+    if render_cache is not None:
+        cache_key = render_cache.key(icon_digest, source_color, target_color, size,
+                                     tolerance, tint, ICON_ENCODER_SETTINGS)
+        png_bytes = render_cache.get(cache_key)
+        if png_bytes is not None:
+            return png_bytes
+
+    if _is_indexed_png(icon_bytes):
+        if tint:
+            png_bytes = _tint_indexed_png(icon_bytes, target_color)
+        else:
+            png_bytes = _recolor_indexed_png(icon_bytes, color_map, tolerance)
     else:
-        icon_color = "000000"
+        width, height, pixels, metadata = get_decoded_icon(icon_key, size, library, icon_bytes, icon_digest)
+        if tint:
+            png_bytes = _encode_png(*_tint_pixels(pixels, metadata, target_color))
+        else:
+            png_bytes = _encode_png(_recolor_pixels(pixels, metadata, color_map, tolerance), metadata)
+    if render_cache is not None:
+        render_cache.put(cache_key, png_bytes)
+    return png_bytes
 
-    print "Rendering icon: %s\tcolor=%s size=%s" % (icon_key, icon_color, icon_size)
 
-    png_bytes = recolor_png(get_icon_from_library(icon_key, icon_size or 50), (0, 0, 0), parse_color(icon_color))
+def _normalize_icon_color(icon_color):
+    if icon_color:
+        return str(icon_color).replace("#", "")
+    return "000000"
+
+
+def _write_icon(file_path, png_bytes):
     _create_dir_if_not_exists(file_path)
     with open(file_path, 'wb+') as output:
         output.write(png_bytes)
 
 
+def download_icon(icon_key, icon_color, icon_size, file_path, library=None, tolerance=0, tint=False):
+    icon_color = _normalize_icon_color(icon_color)
+
+    print "Rendering icon: %s\tcolor=%s size=%s" % (icon_key, icon_color, icon_size)
+
+    _write_icon(file_path, render_icon(icon_key, icon_color, icon_size, library, tolerance=tolerance, tint=tint))
+
+
+IconJobResult = namedtuple('IconJobResult', 'icon_key icon_color icon_size file_path seconds error')
+
+
+def _init_icon_worker(library_path):
+    global _icon_library
+    # Every worker process needs its own handle, the file position of an inherited one is shared with the parent
+    _icon_library = IconLibrary(library_path)
+
+
+def _render_icon_task(task, library=None):
+    (icon_key, icon_color, icon_size), file_paths, render_options = task
+    start = time.time()
+    try:
+        print "Rendering icon: %s\tcolor=%s size=%s" % (icon_key, icon_color, icon_size)
+        png_bytes = render_icon(icon_key, icon_color, icon_size, library, **render_options)
+        for file_path in file_paths:
+            _write_icon(file_path, png_bytes)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return time.time() - start, error
+
+
+def download_icons(jobs, processes=None, library_path=ICON_LIBRARY_PATH, tolerance=0, tint=False):
+    """Renders a batch of icons in parallel.
+
+    Args:
+        jobs (list of tuple): (icon_key, icon_color, icon_size, file_path) tuples, like the download_icon arguments
+        processes (int): number of worker processes, defaults to the number of cores. With 1 the icons are rendered
+            in the current process.
+        library_path (unicode): path of the icon library
+        tolerance (int): see remap_png_colors
+        tint (bool): see render_icon
+
+    Returns:
+        list of IconJobResult: one result per job, in the order of `jobs`. Jobs that need the same rendered icon are
+            rendered once; they all report the time of that render. `error` contains the traceback of a failed job.
+    """
+    jobs = [(icon_key, _normalize_icon_color(icon_color), icon_size, file_path)
+            for icon_key, icon_color, icon_size, file_path in jobs]
+    renders = OrderedDict()
+    for icon_key, icon_color, icon_size, file_path in jobs:
+        file_paths = renders.setdefault((icon_key, icon_color, icon_size or 50), [])
+        if file_path not in file_paths:
+            file_paths.append(file_path)
+    render_options = {'tolerance': tolerance, 'tint': tint}
+    tasks = [(render, render_file_paths, render_options) for render, render_file_paths in renders.iteritems()]
+    if not tasks:
+        return []
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(tasks))
+    # Opened in this process first: a missing or corrupt library must raise here, the pool keeps respawning workers
+    # whose initializer fails and would never return
+    library = IconLibrary(library_path)
+    if processes <= 1:
+        try:
+            outcomes = [_render_icon_task(task, library) for task in tasks]
+        finally:
+            library.close()
+    else:
+        library.close()
+        pool = multiprocessing.Pool(processes, _init_icon_worker, (library_path,))
+        try:
+            outcomes = pool.map(_render_icon_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    outcome_per_render = dict(zip(renders.iterkeys(), outcomes))
+    return [IconJobResult(icon_key, icon_color, icon_size, file_path,
+                          *outcome_per_render[(icon_key, icon_color, icon_size or 50)])
+            for icon_key, icon_color, icon_size, file_path in jobs]
+
+
+def validate_png(file_path, max_pixels=None, max_file_size=None):
+    """Checks a PNG file for corruption without decoding its pixels, see png.Reader.verify.
+
+    Args:
+        file_path (unicode)
+        max_pixels (int): reject images with more pixels than this
+        max_file_size (int): reject files larger than this many bytes
+
+    Returns:
+        dict: JSON serializable result with the keys path, bytes, seconds and error (None for a valid file), plus
+            width, height, bitdepth, color_type and interlace when the header could be read.
+    """
+    start = time.time()
+    result = {'path': file_path, 'bytes': None, 'error': None}
+    reader = None
+    try:
+        result['bytes'] = os.path.getsize(file_path)
+        if max_file_size is not None and result['bytes'] > max_file_size:
+            raise png.FormatError('File is too large: %d bytes.' % result['bytes'])
+        reader = png.Reader(filename=file_path)
+        meta = reader.verify(max_pixels)
+        for key in ('width', 'height', 'bitdepth', 'color_type', 'interlace'):
+            result[key] = meta[key]
+    except (png.Error, EnvironmentError), e:
+        result['error'] = str(e)
+    except Exception, e:
+        # Whatever goes wrong with one file must not cost the report of the whole tree
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        if reader is not None:
+            reader.file.close()
+    result['seconds'] = time.time() - start
+    return result
+
+
+def _validate_png_task(task):
+    file_path, limits = task
+    return validate_png(file_path, **limits)
+
+
+def validate_png_tree(root, processes=None, max_pixels=None, max_file_size=None):
+    """Validates every PNG file below a directory in parallel, see validate_png.
+
+    Args:
+        root (unicode): directory to walk
+        processes (int): number of worker processes, defaults to the number of cores. With 1 the files are checked
+            in the current process.
+        max_pixels (int): see validate_png
+        max_file_size (int): see validate_png
+
+    Returns:
+        dict: JSON serializable report with the keys root, files (a validate_png result per file, sorted by path),
+            errors (the number of invalid files) and seconds (the wall clock time of the whole run).
+    """
+    start = time.time()
+    file_paths = []
+    for dir_path, _, file_names in os.walk(root):
+        file_paths.extend(os.path.join(dir_path, file_name) for file_name in file_names
+                          if file_name.lower().endswith('.png'))
+    file_paths.sort()
+    limits = {'max_pixels': max_pixels, 'max_file_size': max_file_size}
+    tasks = [(file_path, limits) for file_path in file_paths]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(tasks))
+    if processes <= 1:
+        results = map(_validate_png_task, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_validate_png_task, tasks, chunksize=max(1, len(tasks) / (processes * 4)))
+        finally:
+            pool.close()
+            pool.join()
+
+    return {'root': root,
+            'files': results,
+            'errors': sum(1 for result in results if result['error']),
+            'seconds': time.time() - start}
+
+
 def create_trusstore(app_id, file_path):
     subprocess.check_output('cd %s; rm -f truststore.bks' % CURRENT_DIR, shell=True)
     command = 'cd %s; CLASSPATH=bcprov-jdk15on-146.jar keytool -noprompt -import -alias "ca cert" ' \
@@ -94,6 +599,24 @@ def create_trusstore_der(app_id, file_path):
     shutil.copy2(os.path.join(CURRENT_DIR, "truststore.der"), file_path)
 
 
+def get_image_size(file_path):
+    """Get the size of an image without decoding it.
+
+    PNG files are probed by reading their header only; other formats are opened with PIL (which also only reads the
+    header until the pixels are needed).
+
+    Args:
+        file_path (str)
+    Returns:
+        tuple: (width, height)
+    """
+    try:
+        return png.probe(file_path)['size']
+    except (png.FormatError, ValueError):
+        # Not a PNG file, or a truncated one: let PIL open it or raise a clear error
+        return Image.open(file_path).size
+
+
 def resize_image(src_img, dest_path, width, height):
     im1 = Image.open(src_img)
     im2 = im1.resize((width, height), Image.ANTIALIAS)  # best down-sizing filter
@@ -177,23 +700,266 @@ def parse_color(color):
     return tuple(map(lambda x: int(x, 16), m.groups()))
 
 
-def recolor_png(png_bytes, source_color, target_color):
-    def map_color(row, png_details):
-        i = iter(row)
-        if png_details['alpha']:
-            return itertools.chain(*(target_color + b[3:] if b[:3] == source_color else b for b in itertools.izip(i, i, i, i)))
-        else:
-            return itertools.chain(*(target_color if b == source_color else b for b in itertools.izip(i, i, i)))
+def _decode_png(png_bytes, checksums='strict'):
+    return png.Reader(bytes=str(png_bytes), checksums=checksums).read_flat()
+
 
-    r = png.Reader(file=StringIO(str(png_bytes)))
-    p = r.read()
-    c = p[2]
+def _encode_png(pixels, metadata):
     f = StringIO()
-    w = png.Writer(**p[3])
-    w.write(f, [map_color(row, p[3]) for row in c])
+    w = png.Writer(preset=ICON_ENCODER_PRESET, **metadata)
+    w.write_array(f, pixels)
     return f.getvalue()
 
 
+# The recolouring below works on whole channels at once instead of on a tuple per pixel. Without numpy, a channel
+# (every `planes`-th byte) is turned into one big integer with one byte per pixel, so that comparing and replacing
+# values of all pixels boils down to a few str.translate calls and bitwise operations on those integers.
+
+def _bytes_to_int(data):
+    return int(binascii.hexlify(data), 16) if data else 0
+
+
+def _int_to_bytes(value, length):
+    return binascii.unhexlify('%0*x' % (2 * length, value))
+
+
+_match_tables = {}
+
+
+def _match_table(value, tolerance=0):
+    """Translation table that maps the bytes within `tolerance` of `value` to 1 and every other byte to 0."""
+    key = (value, tolerance)
+    table = _match_tables.get(key)
+    if table is None:
+        table = _match_tables[key] = ''.join('\x01' if abs(i - value) <= tolerance else '\x00' for i in xrange(256))
+    return table
+
+
+def _normalize_color_map(color_map):
+    if isinstance(color_map, dict):
+        color_map = color_map.iteritems()
+    return [(tuple(source_color), tuple(target_color)) for source_color, target_color in color_map]
+
+
+def _recolor_flat(data, planes, color_map, tolerance=0):
+    """Recolours the pixels in `data`, a string of 8-bit RGB or RGBA pixels. Returns the new pixels as an array.
+
+    A pixel matches a source colour of `color_map` when none of its RGB values differs more than `tolerance` from the
+    source colour. Pixels get the target colour of the first source colour they match.
+    """
+    if numpy is not None:
+        pixels = numpy.frombuffer(data, numpy.uint8).reshape(-1, planes)
+        rgb = pixels[:, :3].astype(numpy.int16)
+        pixels = pixels.copy()
+        matched = numpy.zeros(len(pixels), numpy.bool_)
+        for source_color, target_color in color_map:
+            mask = (numpy.abs(rgb - source_color) <= tolerance).all(axis=1) & ~matched
+            pixels[mask, :3] = target_color
+            matched |= mask
+        return array('B', pixels.tostring())
+
+    result = array('B', data)
+    pixel_count = len(data) // planes
+    channels = [data[i::planes] for i in xrange(3)]
+    # One 0x01 byte for every pixel that got a new colour, 0x00 for all others
+    matched = 0
+    # The new values of the matched pixels for every channel, 0x00 for all other pixels
+    replacements = [0, 0, 0]
+    for source_color, target_color in color_map:
+        mask = -1
+        for i in xrange(3):
+            mask &= _bytes_to_int(channels[i].translate(_match_table(source_color[i], tolerance)))
+            if not mask:
+                break
+        # Pixels that matched an earlier source colour keep that one
+        mask &= ~matched
+        if not mask:
+            continue
+        matched |= mask
+        for i in xrange(3):
+            replacements[i] |= mask * target_color[i]
+    if not matched:
+        return result
+    keep = ~(matched * 0xff)
+    for i in xrange(3):
+        channel = (_bytes_to_int(channels[i]) & keep) | replacements[i]
+        result[i::planes] = array('B', _int_to_bytes(channel, pixel_count))
+    return result
+
+
+def _recolor_pixels(pixels, metadata, color_map, tolerance=0):
+    """Returns a recoloured copy of `pixels` (flat row flat pixel format), see _recolor_flat. The alpha channel is
+    kept."""
+    if metadata['bitdepth'] == 8 and not metadata['greyscale']:
+        return _recolor_flat(pixels.tostring(), metadata['planes'], color_map, tolerance)
+
+    def lookup(color):
+        for source_color, target_color in color_map:
+            if all(abs(a - b) <= tolerance for a, b in zip(color, source_color)):
+                return target_color
+        return None
+
+    def map_color(pixel):
+        target_color = lookup(pixel[:3])
+        return pixel if target_color is None else target_color + pixel[3:]
+
+    i = iter(pixels)
+    if metadata['alpha']:
+        values = itertools.imap(map_color, itertools.izip(i, i, i, i))
+    else:
+        values = itertools.imap(map_color, itertools.izip(i, i, i))
+    return array(pixels.typecode, itertools.chain.from_iterable(values))
+
+
+def _is_indexed_png(png_bytes):
+    reader = png.Reader(bytes=png_bytes)
+    reader.preamble()
+    return reader.colormap
+
+
+def _rewrite_palette(reader, outfile, rewrite):
+    """Copies a colour mapped PNG, replacing its PLTE chunk by rewrite(plte_data). All other chunks, the image data
+    included, are copied verbatim."""
+    png.rewrite_chunks(reader, outfile, replace={'PLTE': rewrite(reader.read_indexed('PLTE'))})
+
+
+def _recolor_indexed_png(png_bytes, color_map, tolerance=0):
+    """Recolours a colour mapped (colour type 3) PNG by rewriting its palette, all other chunks are copied as is."""
+    f = StringIO()
+    _rewrite_palette(png.Reader(bytes=png_bytes), f,
+                     lambda plte: _recolor_flat(plte, 3, color_map, tolerance).tostring())
+    return f.getvalue()
+
+
+def remap_png_colors(png_bytes, color_map, tolerance=0):
+    """Replaces several colours of a PNG image in a single pass.
+
+    Args:
+        png_bytes (str)
+        color_map (dict or list of tuple): maps source RGB tuples to target RGB tuples. Use a list of
+            (source_color, target_color) pairs when the order matters: pixels get the target colour of the first
+            source colour they match.
+        tolerance (int): maximum difference per RGB value between a pixel and a source colour, e.g. to also recolour
+            the anti-aliased edges of an icon
+
+    Returns:
+        str: the recoloured PNG. The alpha channel is left untouched.
+    """
+    color_map = _normalize_color_map(color_map)
+    png_bytes = str(png_bytes)
+    if _is_indexed_png(png_bytes):
+        return _recolor_indexed_png(png_bytes, color_map, tolerance)
+    width, height, pixels, metadata = _decode_png(png_bytes)
+    return _encode_png(_recolor_pixels(pixels, metadata, color_map, tolerance), metadata)
+
+
+def recolor_png(png_bytes, source_color, target_color, tolerance=0):
+    return remap_png_colors(png_bytes, [(source_color, target_color)], tolerance)
+
+
+def _tint_pixels(pixels, metadata, target_color):
+    """Returns (pixels, metadata) of a copy of the image in which every pixel has `target_color` and the alpha value of
+    the corresponding source pixel. Greyscale images with alpha are converted to RGBA."""
+    if not metadata['alpha']:
+        raise ValueError('Only images with an alpha channel can be tinted')
+    if metadata['bitdepth'] > 8:
+        # Scale the 8-bit colour to the bit depth of the image
+        factor = (2 ** metadata['bitdepth'] - 1) / 255.0
+        target_color = tuple(int(round(value * factor)) for value in target_color)
+
+    pixel_count = len(pixels) // metadata['planes']
+    if metadata['greyscale']:
+        result = array(pixels.typecode, [0]) * (pixel_count * 4)
+        result[3::4] = pixels[1::2]
+        metadata = dict(metadata, greyscale=False, planes=4)
+        if metadata.get('background'):
+            # A greyscale bKGD chunk holds a single value, RGB images need a triple
+            metadata['background'] = metadata['background'] * 3
+    else:
+        result = array(pixels.typecode, pixels)
+    for i, value in enumerate(target_color):
+        result[i::4] = array(pixels.typecode, [value]) * pixel_count
+    return result, metadata
+
+
+def _tint_indexed_png(png_bytes, target_color):
+    """Tints a colour mapped PNG by giving every palette entry the target colour, the tRNS chunk (the alpha values of
+    the palette) is kept."""
+    reader = png.Reader(bytes=png_bytes)
+    if not any(chunk_type == 'tRNS' for chunk_type, _, _ in reader.index_chunks()):
+        raise ValueError('Only images with an alpha channel can be tinted')
+    f = StringIO()
+    _rewrite_palette(reader, f, lambda plte: array('B', target_color).tostring() * (len(plte) // 3))
+    return f.getvalue()
+
+
+def tint_png(png_bytes, target_color):
+    """Uses a PNG image as an alpha mask: every pixel gets `target_color` (an RGB tuple) while its alpha value is kept,
+    whatever its original colour was. Unlike recolor_png this also colours the anti-aliased edges of monochrome glyphs
+    correctly.
+
+    Raises:
+        ValueError: if the image has no alpha channel
+    """
+    png_bytes = str(png_bytes)
+    if _is_indexed_png(png_bytes):
+        return _tint_indexed_png(png_bytes, target_color)
+    width, height, pixels, metadata = _decode_png(png_bytes)
+    return _encode_png(*_tint_pixels(pixels, metadata, target_color))
+
+
+def recolor_png_stream(infile, outfile, source_color, target_color, tolerance=0):
+    """Like recolor_png, but reads the PNG from the (seekable) file object `infile` and writes the result to `outfile`
+    row by row, so for straightlaced images only a single row of pixels is kept in memory."""
+    color_map = _normalize_color_map([(source_color, target_color)])
+    start = infile.tell()
+    reader = png.Reader(file=infile)
+    reader.preamble()
+    infile.seek(start)
+    if reader.colormap:
+        _rewrite_palette(png.Reader(file=infile), outfile,
+                         lambda plte: _recolor_flat(plte, 3, color_map, tolerance).tostring())
+        return
+
+    # Every row is recoloured into a new array, so the reader may reuse its row buffers
+    width, height, rows, metadata = png.Reader(file=infile).read(reuse_rows=True)
+    w = png.Writer(preset=ICON_ENCODER_PRESET, **metadata)
+    w.write(outfile, (_recolor_pixels(row, metadata, color_map, tolerance) for row in rows))
+
+
+def recolor_png_file(src_path, dest_path, source_color, target_color, tolerance=0):
+    _create_dir_if_not_exists(os.path.abspath(dest_path))
+    with open(src_path, 'rb') as infile, open(dest_path, 'wb') as outfile:
+        recolor_png_stream(infile, outfile, source_color, target_color, tolerance)
+
+
+# Ancillary chunks that affect how the pixels are displayed, everything else (text, timestamps, ...) is metadata
+PNG_DISPLAY_CHUNKS = ('tRNS', 'gAMA', 'cHRM', 'sRGB', 'iCCP', 'sBIT')
+
+
+def sanitize_png_file(src_path, dest_path, keep=PNG_DISPLAY_CHUNKS, add=()):
+    """Strips the metadata from a PNG file without re-encoding it, see png.rewrite_chunks.
+
+    Args:
+        src_path (unicode)
+        dest_path (unicode): may be the same as `src_path`
+        keep (tuple of str): the ancillary chunk types to keep, critical chunks are always kept
+        add (list of tuple): (chunk_type, data) tuples of ancillary chunks to add
+    """
+    dest_path = os.path.abspath(dest_path)
+    _create_dir_if_not_exists(dest_path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as outfile, open(src_path, 'rb') as infile:
+            png.rewrite_chunks(infile, outfile, keep=keep, add=add)
+        # mkstemp creates the file as 0600, the result must keep the permissions of the source
+        shutil.copymode(src_path, tmp_path)
+        os.rename(tmp_path, dest_path)
+    except:
+        _remove_file(tmp_path)
+        raise
+
+
 def create_background(src_file_path, dst_file_path):
     '''Generate an image that can be used for repeating background (1px high) based on a given image.'''
     img = Image.open(src_file_path)
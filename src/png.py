@@ -168,9 +168,12 @@ And now, my famous members
 from __future__ import generators
 
 from array import array
+import binascii
 import math
+import mmap
 import operator  # http://www.python.org/doc/2.4.4/lib/module-operator.html
 import struct
+import sys
 import warnings  # http://www.python.org/doc/2.4.4/lib/module-warnings.html
 import zlib
 
@@ -182,6 +185,13 @@ try: # See :pyver:old
 except:
     pass
 
+# NumPy is optional; when it is available it is used to speed up
+# scanline filtering.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # from com.mobicage.utils import azzert
 def azzert(expr, error=None):
     if not expr:
@@ -239,6 +249,15 @@ except:
     strtobytes = str
     bytestostr = str
 
+# A read-only view on part of a string, array or mmap, without copying.
+try:
+    buffer
+except NameError:
+    def buffer(obj, offset=0, size=None):
+        if size is None:
+            return memoryview(obj)[offset:]
+        return memoryview(obj)[offset:offset + size]
+
 def interleave_planes(ipixels, apixels, ipsize, apsize):
     """
     Interleave (colour) planes, e.g. RGB + A = RGBA.
@@ -332,7 +351,12 @@ class Writer(object):
                  planes=None,
                  colormap=None,
                  maxval=None,
-                 chunk_limit=2 ** 20):
+                 chunk_limit=2 ** 20,
+                 filter_type=None,
+                 workers=None,
+                 strategy=None,
+                 mem_level=None,
+                 preset=None):
         """
         Create a PNG encoder object.
 
@@ -362,6 +386,17 @@ class Writer(object):
           Create an interlaced image.
         chunk_limit
           Write multiple ``IDAT`` chunks to save memory.
+        filter_type
+          Scanline filter: 0 to 4, or ``'adaptive'``.
+        workers
+          Number of threads compressing the image data in parallel.
+        strategy
+          zlib compression strategy.
+        mem_level
+          zlib memory level (1-9).
+        preset
+          Named combination of the compression settings: ``'fast'``,
+          ``'default'``, ``'max'`` or ``'smallest'``.
 
         The image size (in pixels) can be specified either by using the
         `width` and `height` arguments, or with the single `size`
@@ -448,6 +483,54 @@ class Writer(object):
         `chunk_limit` is used to limit the amount of memory used whilst
         compressing the image.  In order to avoid using large amounts of
         memory, multiple ``IDAT`` chunks may be created.
+
+        The `filter_type` argument selects the PNG scanline filter (see
+        http://www.w3.org/TR/PNG/#9Filters ) applied to each row before
+        compression.  It can be one of the filter types 0 ("none"), 1
+        ("sub"), 2 ("up"), 3 ("average") or 4 ("paeth"), which is used
+        for every row, or ``'adaptive'``, in which case each row is
+        filtered with the type that gives the minimum sum of absolute
+        differences (the heuristic recommended by the PNG
+        specification).  Filtering usually makes the compressed image
+        considerably smaller, at the expense of encoding time.  The
+        default, ``None``, is the same as 0.  Filtering is only
+        applied to straightlaced images; interlaced images always use
+        filter type 0.
+
+        If `workers` is greater than 1, the image data is compressed by
+        that many threads at the same time (``zlib`` releases the GIL
+        whilst compressing).  The data is split into blocks of
+        `chunk_limit` bytes, each of which is compressed independently;
+        the image becomes slightly larger as a result, as matches
+        cannot extend back into the previous block.  This only pays off
+        for large images, several times `chunk_limit` in size.
+
+        The `strategy` and `mem_level` arguments are passed on to
+        ``zlib.compressobj`` (see the documentation of the ``zlib``
+        module and of zlib's ``deflateInit2``); the strategy can be one
+        of ``zlib.Z_DEFAULT_STRATEGY``, ``zlib.Z_FILTERED``,
+        ``zlib.Z_HUFFMAN_ONLY`` or :data:`Z_RLE`.  Higher memory levels
+        compress slightly better and faster, at the cost of memory.
+
+        A `preset` sets `compression`, `strategy`, `mem_level` and
+        `filter_type` together (arguments that are given explicitly
+        take precedence):
+
+        ``'fast'``
+          level 1 and the "up" filter (which is cheap, and makes
+          compression at level 1 worthwhile), for quick (debug) builds;
+        ``'default'``
+          the same as not using a preset;
+        ``'max'``
+          level 9, ``Z_FILTERED``, memory level 9 and adaptive
+          filtering;
+        ``'smallest'``
+          as ``'max'``, but the image data is compressed with several
+          strategies at once and the smallest result is kept.  This
+          takes about three times as long as ``'max'``, and keeps the
+          compressed data of each strategy in memory (so that
+          `chunk_limit` no longer limits the memory used, and a single
+          ``IDAT`` chunk is written).
         """
 
         # At the moment the `planes` argument is ignored;
@@ -534,6 +617,30 @@ class Writer(object):
             raise ValueError("bitdepth (%r) must be a postive integer <= 16" %
               bitdepth)
 
+        if filter_type not in (None, 0, 1, 2, 3, 4, 'adaptive'):
+            raise ValueError(
+              "filter_type (%r) must be None, 0 to 4, or 'adaptive'" %
+              filter_type)
+
+        if workers is not None and (not isinteger(workers) or workers < 1):
+            raise ValueError("workers must be a positive integer")
+
+        if preset is not None:
+            if preset not in _presets:
+                raise ValueError("preset (%r) must be one of %s" %
+                  (preset, ', '.join(sorted(_presets))))
+            settings = _presets[preset]
+            if compression is None:
+                compression = settings[0]
+            if strategy is None:
+                strategy = settings[1]
+            if mem_level is None:
+                mem_level = settings[2]
+            if filter_type is None:
+                filter_type = settings[3]
+        if mem_level is not None and mem_level not in range(1, 10):
+            raise ValueError("mem_level must be 1 to 9")
+
         self.rescale = None
         if palette:
             if bitdepth not in (1, 2, 4, 8):
@@ -591,6 +698,11 @@ class Writer(object):
         self.bitdepth = int(bitdepth)
         self.compression = compression
         self.chunk_limit = chunk_limit
+        self.filter_type = filter_type
+        self.workers = workers
+        self.strategy = strategy
+        self.mem_level = mem_level
+        self.preset = preset
         self.interlace = bool(interlace)
         self.palette = check_palette(palette)
 
@@ -636,8 +748,27 @@ class Writer(object):
         """
 
         if self.interlace:
+            # The rows are copied into an array of exactly the size of
+            # the image, allocated up front.
             fmt = 'BH'[self.bitdepth > 8]
-            a = array(fmt, itertools.chain(*rows))
+            vpr = self.width * self.planes
+            a = array(fmt, [0]) * (vpr * self.height)
+            nrows = 0
+            for row in rows:
+                if nrows < self.height:
+                    if not (isarray(row) and row.typecode == fmt):
+                        row = array(fmt, row)
+                    if len(row) != vpr:
+                        raise ValueError(
+                          "row %d has %d values instead of %d" %
+                          (nrows, len(row), vpr))
+                    offset = nrows * vpr
+                    a[offset:offset + vpr] = row
+                nrows += 1
+            if nrows != self.height:
+                raise ValueError(
+                  "rows supplied (%d) does not match height (%d)" %
+                  (nrows, self.height))
             return self.write_array(outfile, a)
         else:
             nrows = self.write_passes(outfile, rows)
@@ -719,10 +850,31 @@ class Writer(object):
                             struct.pack("!3H", *self.background))
 
         # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
-            compressor = zlib.compressobj(self.compression)
+        parallel = False
+        if self.preset == 'smallest':
+            strategies = _smallest_strategies
+            if self.strategy is not None:
+                strategies = [self.strategy]
+            compressor = _SmallestCompressor([
+              _compressobj(self.compression, strategy, self.mem_level)
+              for strategy in strategies])
+        elif self.workers is not None and self.workers > 1:
+            parallel = True
+            compressor = _ParallelCompressor(self.compression, self.workers,
+              self.strategy, self.mem_level)
         else:
-            compressor = zlib.compressobj()
+            compressor = _compressobj(self.compression, self.strategy,
+              self.mem_level)
+        try:
+            return self._write_idat(outfile, rows, packed, compressor)
+        finally:
+            if parallel:
+                compressor.close()
+
+    def _write_idat(self, outfile, rows, packed, compressor):
+        """Write the ``IDAT`` chunks and the ``IEND`` chunk, as the last
+        part of :meth:`write_passes`.
+        """
 
         # Choose an extend function based on the bitdepth.  The extend
         # function packs/decomposes the pixel values into bytes and
@@ -733,25 +885,12 @@ class Writer(object):
         elif self.bitdepth == 16:
             # Decompose into bytes
             def extend(sl):
-                fmt = '!%dH' % len(sl)
-                data.extend(array('B', struct.pack(fmt, *sl)))
+                data.fromstring(_tobigendian(sl))
         else:
             # Pack into bytes
             azzert(self.bitdepth < 8)
-            # samples per byte
-            spb = int(8 / self.bitdepth)
             def extend(sl):
-                a = array('B', sl)
-                # Adding padding bytes so we can group into a whole
-                # number of spb-tuples.
-                l = float(len(a))
-                extra = math.ceil(l / float(spb)) * spb - l
-                a.extend([0] * int(extra))
-                # Pack into bytes
-                l = group(a, spb)
-                l = map(lambda e: reduce(lambda x, y:
-                                           (x << self.bitdepth) + y, e), l)
-                data.extend(l)
+                data.fromstring(_packsamples(sl, self.bitdepth))
         if self.rescale:
             oldextend = extend
             factor = \
@@ -759,6 +898,26 @@ class Writer(object):
             def extend(sl):
                 oldextend(map(lambda x: int(round(factor * x)), sl))
 
+        # Filtering needs each packed row and its (unfiltered)
+        # predecessor.  Rows are packed onto the end of ``data`` as usual,
+        # then taken off again and replaced by their filtered version.
+        # Interlaced images are not filtered, see below.
+        filter_type = self.filter_type
+        if filter_type is None or self.interlace:
+            filter_type = 0
+        # Filter offset, see :meth:`filter_scanline`.
+        fo = max(1, self.psize)
+        def filter_row(start, previous):
+            """Filter the row that starts at `start` in `data`.  Returns
+            the unfiltered row."""
+            line = data[start:]
+            del data[start:]
+            if filter_type == 'adaptive':
+                data.extend(filter_scanline_adaptive(line, fo, previous))
+            else:
+                data.extend(filter_scanline(filter_type, line, fo, previous))
+            return line
+
         # Build the first row, testing mostly to see if we need to
         # changed the extend function to cope with NumPy integer types
         # (they cause our ordinary definition of extend to fail, so we
@@ -768,7 +927,9 @@ class Writer(object):
         del rows
 
         # First row's filter type.
-        data.append(0)
+        if not filter_type:
+            data.append(0)
+        start = len(data)
         # :todo: Certain exceptions in the call to ``.next()`` or the
         # following try would indicate no row data supplied.
         # Should catch.
@@ -781,20 +942,30 @@ class Writer(object):
             # Not only does this work for the (slightly broken) NumPy
             # types, there are probably lots of other, unknown, "nearly"
             # int types it works for.
+            del data[start:]
             def wrapmapint(f):
                 return lambda sl: f(map(int, sl))
             extend = wrapmapint(extend)
             del wrapmapint
             extend(row)
+        previous = None
+        if filter_type:
+            previous = filter_row(start, previous)
 
         for i, row in enumrows:
-            # Add "None" filter type.  Currently, it's essential that
-            # this filter type be used for every scanline as we do not
-            # mark the first row of a reduced pass image; that means we
-            # could accidentally compute the wrong filtered scanline if
-            # we used "up", "average", or "paeth" on such a line.
-            data.append(0)
-            extend(row)
+            # Add "None" filter type, unless the row is filtered.  For
+            # interlaced images it's essential that this filter type be
+            # used for every scanline as we do not mark the first row of
+            # a reduced pass image; that means we could accidentally
+            # compute the wrong filtered scanline if we used "up",
+            # "average", or "paeth" on such a line.
+            if not filter_type:
+                data.append(0)
+                extend(row)
+            else:
+                start = len(data)
+                extend(row)
+                previous = filter_row(start, previous)
             if len(data) > self.chunk_limit:
                 compressed = compressor.compress(tostring(data))
                 if len(compressed):
@@ -824,7 +995,10 @@ class Writer(object):
         """
 
         if self.interlace:
-            self.write_passes(outfile, self.array_scanlines_interlace(pixels))
+            # write_passes is done with each row before it asks for the
+            # next one, so the rows of a pass can share an array.
+            self.write_passes(outfile,
+              self.array_scanlines_interlace(pixels, reuse_rows=True))
         else:
             self.write_passes(outfile, self.array_scanlines(pixels))
 
@@ -860,7 +1034,8 @@ class Writer(object):
             pixels.fromfile(infile,
                             (self.bitdepth / 8) * self.color_planes *
                             self.width * self.height)
-            self.write_passes(outfile, self.array_scanlines_interlace(pixels))
+            self.write_passes(outfile,
+              self.array_scanlines_interlace(pixels, reuse_rows=True))
         else:
             self.write_passes(outfile, self.file_scanlines(infile))
 
@@ -881,7 +1056,8 @@ class Writer(object):
                                    (self.bitdepth / 8) * self.color_planes,
                                    (self.bitdepth / 8))
         if self.interlace:
-            self.write_passes(outfile, self.array_scanlines_interlace(pixels))
+            self.write_passes(outfile,
+              self.array_scanlines_interlace(pixels, reuse_rows=True))
         else:
             self.write_passes(outfile, self.array_scanlines(pixels))
 
@@ -901,9 +1077,8 @@ class Writer(object):
         if self.bitdepth > 8:
             azzert(self.bitdepth == 16)
             row_bytes *= 2
-            fmt = '>%dH' % vpr
             def line():
-                return array('H', struct.unpack(fmt, infile.read(row_bytes)))
+                return _frombigendian(infile.read(row_bytes))
         else:
             def line():
                 scanline = array('B', infile.read(row_bytes))
@@ -925,12 +1100,17 @@ class Writer(object):
             stop = start + vpr
             yield pixels[start:stop]
 
-    def array_scanlines_interlace(self, pixels):
+    def array_scanlines_interlace(self, pixels, reuse_rows=False):
         """
         Generator for interlaced scanlines from an array.  `pixels` is
         the full source image in flat row flat pixel format.  The
         generator yields each scanline of the reduced passes in turn, in
         boxed row flat pixel format.
+
+        If `reuse_rows` is true then the scanlines of a pass (except
+        the last pass, whose scanlines are slices of `pixels`) are
+        assembled in the same array, so each scanline is only valid
+        until the next one is requested.
         """
 
         # http://www.w3.org/TR/PNG/#8InterlaceMethods
@@ -945,14 +1125,14 @@ class Writer(object):
             ppr = int(math.ceil((self.width - xstart) / float(xstep)))
             # number of values in reduced image row.
             row_len = ppr * self.planes
+            row = array(fmt, [0]) * row_len
             for y in range(ystart, self.height, ystep):
                 if xstep == 1:
                     offset = y * vpr
                     yield pixels[offset:offset + vpr]
                 else:
-                    row = array(fmt)
-                    # There's no easier way to set the length of an array
-                    row.extend(pixels[0:row_len])
+                    if not reuse_rows:
+                        row = array(fmt, [0]) * row_len
                     offset = y * vpr + xstart * self.planes
                     end_offset = (y + 1) * vpr
                     skip = self.planes * xstep
@@ -977,6 +1157,164 @@ def write_chunk(outfile, tag, data=strtobytes('')):
     checksum &= 2 ** 32 - 1
     outfile.write(struct.pack("!I", checksum))
 
+def _checkchunk(type, data, checksum):
+    """Check the 4 byte big-endian CRC `checksum` of a chunk of type
+    `type` with content `data`, raising :exc:`ChunkError` if it does not
+    match.
+    """
+
+    verify = zlib.crc32(strtobytes(type))
+    verify = zlib.crc32(data, verify)
+    # Whether the output from zlib.crc32 is signed or not varies
+    # according to hideous implementation details, see
+    # http://bugs.python.org/issue1202 .
+    # We coerce it to be positive here (in a way which works on
+    # Python 2.3 and older).
+    verify &= 2 ** 32 - 1
+    (expected,) = struct.unpack('!I', checksum)
+    if expected != verify:
+        raise ChunkError(
+          "Checksum error in %s chunk: 0x%08X != 0x%08X." %
+          (type, expected, verify))
+
+# The run-length encoding strategy.  zlib has supported it since
+# version 1.2.0, but the Python 2 ``zlib`` module does not define it.
+Z_RLE = getattr(zlib, 'Z_RLE', 3)
+
+# The Writer presets: (compression level, strategy, memory level,
+# filter type).
+_presets = {
+  'fast': (1, zlib.Z_DEFAULT_STRATEGY, 8, 2),
+  'default': (zlib.Z_DEFAULT_COMPRESSION, zlib.Z_DEFAULT_STRATEGY, 8, 0),
+  'max': (9, zlib.Z_FILTERED, 9, 'adaptive'),
+  'smallest': (9, None, 9, 'adaptive'),
+}
+# The strategies tried by the 'smallest' preset.
+_smallest_strategies = (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, Z_RLE)
+
+def _compressobj(level=None, strategy=None, mem_level=None,
+  wbits=zlib.MAX_WBITS):
+    """Like ``zlib.compressobj``, but with defaults for all arguments
+    that are ``None``.
+    """
+
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    if strategy is None:
+        strategy = zlib.Z_DEFAULT_STRATEGY
+    if mem_level is None:
+        mem_level = 8
+    return zlib.compressobj(level, zlib.DEFLATED, wbits, mem_level, strategy)
+
+def _deflate(data, level, strategy, mem_level):
+    """Compress `data` as a raw deflate stream (without zlib header
+    and checksum) that ends on a byte boundary, see
+    :class:`_ParallelCompressor`.
+    """
+
+    compressor = _compressobj(level, strategy, mem_level, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+class _SmallestCompressor(object):
+    """
+    A replacement for ``zlib.compressobj()`` (supporting only its
+    `compress` and `flush` methods) that passes all data to several
+    compressor objects and returns the smallest of their compressed
+    streams when flushed.
+    """
+
+    def __init__(self, compressors):
+        self.compressors = compressors
+        self.outputs = [[] for compressor in compressors]
+
+    def compress(self, data):
+        for compressor, output in zip(self.compressors, self.outputs):
+            output.append(compressor.compress(data))
+        return strtobytes('')
+
+    def flush(self):
+        streams = []
+        for compressor, output in zip(self.compressors, self.outputs):
+            output.append(compressor.flush())
+            streams.append(strtobytes('').join(output))
+        self.outputs = None
+        return min(streams, key=len)
+
+class _ParallelCompressor(object):
+    """
+    A replacement for ``zlib.compressobj()`` (supporting only its
+    `compress` and `flush` methods) that compresses the data given to
+    each `compress` call as an independent block, in a pool of worker
+    threads.
+
+    Each block is a raw deflate stream that ends with a full flush, so
+    that it ends on a byte boundary without marking the end of the
+    stream; concatenated, preceded by a zlib header and followed by an
+    empty final block and the Adler-32 checksum of all the data (which
+    is computed as the data is passed in), they form one valid zlib
+    stream.  Compressed blocks are returned in order, as they become
+    available; at most twice as many blocks as there are threads are
+    kept pending, which bounds the memory used.
+
+    (With ``zlib`` modules that support a preset dictionary, each
+    block could be primed with the end of the previous one to recover
+    most of the compression ratio lost to splitting; the Python 2
+    ``zlib`` module does not support that.)
+    """
+
+    def __init__(self, level, workers, strategy=None, mem_level=None):
+        from multiprocessing.pool import ThreadPool
+
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        self.level = level
+        self.strategy = strategy
+        self.mem_level = mem_level
+        self.pool = ThreadPool(workers)
+        self.limit = 2 * workers
+        self.pending = []
+        self.adler = 1
+        # zlib header: deflate with a 32K window, then the FLEVEL bits
+        # for the compression level and a check value (see RFC 1950).
+        flevel = 2
+        if 0 <= level < 2:
+            flevel = 0
+        elif 2 <= level < 6:
+            flevel = 1
+        elif level > 6:
+            flevel = 3
+        cmf = 0x78
+        flg = flevel << 6
+        flg += 31 - ((cmf << 8) + flg) % 31
+        self.header = struct.pack('BB', cmf, flg)
+
+    def compress(self, data):
+        self.adler = zlib.adler32(data, self.adler)
+        self.pending.append(
+          self.pool.apply_async(_deflate,
+            (data, self.level, self.strategy, self.mem_level)))
+        out = []
+        while len(self.pending) > self.limit:
+            out.append(self.pending.pop(0).get())
+        return self.takeheader() + strtobytes('').join(out)
+
+    def flush(self):
+        out = [result.get() for result in self.pending]
+        self.pending = []
+        # An empty final block (fixed Huffman codes) ends the stream.
+        out.append(strtobytes('\x03\x00'))
+        out.append(struct.pack('!I', self.adler & (2 ** 32 - 1)))
+        return self.takeheader() + strtobytes('').join(out)
+
+    def takeheader(self):
+        header = self.header
+        self.header = strtobytes('')
+        return header
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
 def write_chunks(out, chunks):
     """Create a PNG file by writing out the chunks."""
 
@@ -984,6 +1322,115 @@ def write_chunks(out, chunks):
     for chunk in chunks:
         write_chunk(out, *chunk)
 
+# Ancillary chunks that must precede the ``PLTE`` chunk, see
+# http://www.w3.org/TR/PNG/#5ChunkOrdering .
+_before_plte = ('cHRM', 'gAMA', 'iCCP', 'sBIT', 'sRGB')
+
+def iscritical(type):
+    """Whether chunks of type `type` are critical (as opposed to
+    ancillary), according to the case of its first letter.
+    """
+
+    return not ord(strtobytes(type)[0:1]) & 0x20
+
+def rewrite_chunks(infile, outfile, drop=(), keep=None, replace=None,
+  add=()):
+    """Copy a PNG file chunk by chunk, editing its ancillary chunks,
+    without decoding the image: the ``IDAT`` chunks (and all other
+    chunks that are not edited) are copied verbatim, including their
+    original checksum.
+
+    `infile` is a :class:`Reader` (which must not have read any chunks
+    yet), or a filename, file or array as accepted by its constructor;
+    `outfile` is a file object that the new PNG file is written to.
+
+    `drop` is a collection of chunk types to leave out.  If `keep` is
+    not ``None``, only the critical chunks and the ancillary chunks
+    whose type is in `keep` are copied.  `replace` is a dictionary
+    that maps chunk types to new chunk data: the first chunk of each of
+    those types is replaced, any others are left out (and if there is
+    none, it is added as for `add`).  `add` is a sequence of
+    (*type*, *data*) pairs for extra chunks; these are inserted before
+    the ``PLTE`` chunk for the types that must precede it, and before
+    the first ``IDAT`` chunk otherwise.  Added and replacement chunks
+    are not subject to `drop` and `keep`.
+
+    Raises :exc:`ValueError` when asked to drop or add critical chunks,
+    or to replace ``IHDR``, ``IDAT`` or ``IEND``; only ``PLTE`` may be
+    replaced, as the image data stays the same.
+    """
+
+    drop = set(drop)
+    replace = dict(replace or {})
+    add = list(add)
+    for type in drop:
+        if iscritical(type):
+            raise ValueError("cannot drop critical chunk %s" % type)
+    for type, data in add:
+        if iscritical(type):
+            raise ValueError("cannot add critical chunk %s" % type)
+    for type in replace:
+        if iscritical(type) and type != 'PLTE':
+            raise ValueError("cannot replace critical chunk %s" % type)
+
+    if isinstance(infile, Reader):
+        reader = infile
+    else:
+        reader = Reader(infile)
+    reader.validate_signature()
+
+    # Chunks still to be inserted, before PLTE and before IDAT, as
+    # (*type*, *data*, *replacement*) triples.
+    early = [(type, data, False) for type, data in add
+             if type in _before_plte]
+    late = [(type, data, False) for type, data in add
+            if type not in _before_plte]
+    for type, data in replace.items():
+        if type in _before_plte:
+            early.append((type, data, True))
+        else:
+            late.append((type, data, True))
+    # Types from `replace` that have been written.
+    replaced = set()
+
+    outfile.write(_signature)
+    while True:
+        if not reader.atchunk:
+            reader.atchunk = reader.chunklentype()
+            if reader.atchunk is None:
+                break
+        length, type = reader.atchunk
+        reader.atchunk = None
+        data, checksum = reader.chunkdata(length, type, view=True)
+        reader.checkchunk(type, data, checksum)
+
+        if type in ('PLTE', 'IDAT'):
+            insert = early
+            if type == 'IDAT':
+                insert += late
+                late = []
+            early = []
+            for itype, idata, replacement in insert:
+                if replacement:
+                    if itype in replaced:
+                        continue
+                    replaced.add(itype)
+                write_chunk(outfile, itype, idata)
+
+        if type in replace:
+            if type not in replaced:
+                write_chunk(outfile, type, replace[type])
+                replaced.add(type)
+            continue
+        if type in drop:
+            continue
+        if keep is not None and type not in keep and not iscritical(type):
+            continue
+        outfile.write(struct.pack("!I", length))
+        outfile.write(strtobytes(type))
+        outfile.write(data)
+        outfile.write(checksum)
+
 def filter_scanline(type, line, fo, prev=None):
     """Apply a scanline filter to a scanline.  `type` specifies the
     filter type (0 to 4); `line` specifies the current (unfiltered)
@@ -992,57 +1439,16 @@ def filter_scanline(type, line, fo, prev=None):
     filter offset; normally this is size of a pixel in bytes (the number
     of bytes per sample times the number of channels), but when this is
     < 1 (for bit depths < 8) then the filter offset is 1.
+
+    The whole scanline is filtered at once, using NumPy when it is
+    available and :func:`_filter_bytes` otherwise.
     """
 
     azzert(0 <= type < 5)
 
-    # The output array.  Which, pathetically, we extend one-byte at a
-    # time (fortunately this is linear).
+    # The output array.
     out = array('B', [type])
 
-    def sub():
-        ai = -fo
-        for x in line:
-            if ai >= 0:
-                x = (x - line[ai]) & 0xff
-            out.append(x)
-            ai += 1
-    def up():
-        for i, x in enumerate(line):
-            x = (x - prev[i]) & 0xff
-            out.append(x)
-    def average():
-        ai = -fo
-        for i, x in enumerate(line):
-            if ai >= 0:
-                x = (x - ((line[ai] + prev[i]) >> 1)) & 0xff
-            else:
-                x = (x - (prev[i] >> 1)) & 0xff
-            out.append(x)
-            ai += 1
-    def paeth():
-        # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
-        ai = -fo # also used for ci
-        for i, x in enumerate(line):
-            a = 0
-            b = prev[i]
-            c = 0
-
-            if ai >= 0:
-                a = line[ai]
-                c = prev[ai]
-            p = a + b - c
-            pa = abs(p - a)
-            pb = abs(p - b)
-            pc = abs(p - c)
-            if pa <= pb and pa <= pc: Pr = a
-            elif pb <= pc: Pr = b
-            else: Pr = c
-
-            x = (x - Pr) & 0xff
-            out.append(x)
-            ai += 1
-
     if not prev:
         # We're on the first line.  Some of the filters can be reduced
         # to simpler cases which makes handling the line "off the top"
@@ -1050,23 +1456,353 @@ def filter_scanline(type, line, fo, prev=None):
         # "left" (non-trivial, but true). "average" needs to be handled
         # specially.
         if type == 2: # "up"
-            return line # type = 0
+            out.extend(line)
+            return out
         elif type == 3:
             prev = [0] * len(line)
         elif type == 4: # "paeth"
             type = 1
     if type == 0:
         out.extend(line)
-    elif type == 1:
-        sub()
-    elif type == 2:
-        up()
-    elif type == 3:
-        average()
-    else: # type == 4
-        paeth()
+        return out
+    line = _asbytes(line)
+    if prev:
+        prev = _asbytes(prev)
+    if numpy is not None:
+        out.fromstring(_filter_numpy(type, line, fo, prev))
+    else:
+        out.fromstring(_filter_bytes(type, line, fo, prev))
     return out
 
+def _asbytes(seq):
+    """Convert a sequence of bytes (array, list, or string) to a
+    string."""
+
+    if isinstance(seq, str):
+        return seq
+    if isarray(seq) and seq.typecode == 'B':
+        return tostring(seq)
+    return tostring(array('B', seq))
+
+# Scanline filtering without NumPy.  Rather than processing a
+# scanline one byte at a time, the scanline is converted to one big
+# (long) integer in which each byte of the scanline is an 8-bit (or
+# 16-bit) "lane".  The arithmetic of the filters can then be done on
+# all lanes at once, using a handful of (C speed) operations on long
+# integers, taking care that carries and borrows never cross from one
+# lane into the next.
+
+_lane_constants = {}
+
+def _lanes(value, n, width=8):
+    """Return a long integer with `n` lanes of `width` bits that each
+    hold `value`."""
+
+    key = (value, n, width)
+    x = _lane_constants.get(key)
+    if x is None:
+        if len(_lane_constants) > 256:
+            _lane_constants.clear()
+        x = _lane_constants[key] = int(('%0*x' % (width // 4, value)) * n, 16)
+    return x
+
+def _bytestoint(s):
+    return int(binascii.hexlify(s), 16)
+
+def _inttobytes(x, n):
+    return binascii.unhexlify('%0*x' % (2 * n, x))
+
+def _widen(s):
+    """Convert the string `s` to a long integer with one 16-bit lane per
+    byte."""
+
+    wide = array('B', [0]) * (2 * len(s))
+    wide[1::2] = array('B', s)
+    return _bytestoint(tostring(wide))
+
+def _narrow(x, n):
+    """Inverse of :func:`_widen`; the lanes must hold values < 256."""
+
+    return _inttobytes(x, 2 * n)[1::2]
+
+def _lanesub(x, y, n):
+    """Lane-wise ``(x - y) & 0xff`` for `n` lanes of 8 bits."""
+
+    # Setting the top bit of each lane of x, and clearing it in y,
+    # makes sure that no lane borrows from its neighbour; the top bits
+    # are then fixed up.
+    high = _lanes(0x80, n)
+    return ((x | high) - (y & ~high)) ^ ((x ^ ~y) & high)
+
+def _filter_bytes(type, line, fo, prev):
+    """Filter the scanline `line` (a string) with the filter `type`
+    (1 to 4), without the leading filter type byte.  `prev` is the
+    previous scanline as a string; it can be ``None`` only for filter
+    type 1.  Returns a string."""
+
+    n = len(line)
+    if type == 4:
+        return _filter_paeth(line, fo, prev)
+    x = _bytestoint(line)
+    if type == 1:
+        # The byte to the left of each byte; the first `fo` bytes have
+        # no such byte and use 0.
+        y = x >> (8 * fo)
+    elif type == 2:
+        y = _bytestoint(prev)
+    else:
+        a = x >> (8 * fo)
+        b = _bytestoint(prev)
+        # Lane-wise floor((a + b) / 2) without overflow.
+        y = (a & b) + (((a ^ b) >> 1) & _lanes(0x7f, n))
+    return _inttobytes(_lanesub(x, y, n), n)
+
+def _filter_paeth(line, fo, prev):
+    """Paeth filter, see :func:`_filter_bytes`.  The intermediate values
+    of the Paeth predictor need more than 8 bits, so this works on 16-bit
+    lanes."""
+
+    n = len(line)
+    def lanes(value):
+        return _lanes(value, n, 16)
+    def absolute(u, bias, mask):
+        """Lane-wise ``abs(u - bias)`` for lanes 0 < u < 2 * bias, where
+        bias is a power of 2 and mask is bias - 1."""
+        # Lanes where u < bias; there abs(u - bias) == (u ^ mask) + 1.
+        negative = ((u >> bias.bit_length() - 1) & lanes(1)) ^ lanes(1)
+        return ((u & lanes(mask)) ^ (negative * mask)) + negative
+    def lessequal(u, v):
+        """Lane-wise ``u <= v`` as 0 or 1, for lanes < 1024."""
+        return ((v + lanes(0x400) - u) >> 10) & lanes(1)
+
+    x = _widen(line)
+    b = _widen(prev)
+    a = x >> (16 * fo)
+    c = b >> (16 * fo)
+    # See http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth ; with
+    # p = a + b - c, pa = abs(p - a) = abs(b - c) and so on.  Biases are
+    # added to keep all lanes positive.
+    pa = absolute(b + lanes(0x100) - c, 0x100, 0xff)
+    pb = absolute(a + lanes(0x100) - c, 0x100, 0xff)
+    pc = absolute(a + b + lanes(0x200) - c - c, 0x200, 0x1ff)
+    usea = lessequal(pa, pb) & lessequal(pa, pc)
+    useb = lessequal(pb, pc) & ~usea
+    usec = lanes(1) ^ usea ^ useb
+    predictor = ((a & usea * 0xffff) | (b & useb * 0xffff) |
+                 (c & usec * 0xffff))
+    return _narrow((x + lanes(0x100) - predictor) & lanes(0xff), n)
+
+# Undoing the filters, for :meth:`Reader.undo_filter`.  Each of these
+# functions reconstructs the scanline `result` in place, given the
+# reconstructed `previous` scanline and the filter unit `fu`.  "up"
+# and "sub" are done for the whole scanline at once, using NumPy when it
+# is available and otherwise long integer lanes (see
+# :func:`_filter_bytes`).  "average" and "paeth" depend on the
+# reconstructed byte to the left, so they are inherently sequential;
+# they use a plain loop over Python lists, which is faster than
+# indexing arrays.
+
+def _laneadd(x, y, n):
+    """Lane-wise ``(x + y) & 0xff`` for `n` lanes of 8 bits."""
+
+    high = _lanes(0x80, n)
+    return ((x & ~high) + (y & ~high)) ^ ((x ^ y) & high)
+
+def _packsamples(samples, bitdepth):
+    """Pack a row of samples with a bit depth of 1, 2 or 4 into bytes,
+    the first sample going into the most significant bits of the first
+    byte.  The row is padded with zero bits to a whole number of bytes.
+    Returns a string.
+    """
+
+    # Samples per byte
+    spb = 8 // bitdepth
+    mask = 2 ** bitdepth - 1
+    if numpy is not None:
+        a = numpy.asarray(samples, dtype=numpy.uint8) & mask
+        extra = -len(a) % spb
+        if extra:
+            a = numpy.concatenate((a, numpy.zeros(extra, numpy.uint8)))
+        if bitdepth == 1:
+            return numpy.packbits(a).tostring()
+        a = a.reshape(-1, spb)
+        packed = numpy.zeros(len(a), numpy.uint8)
+        for i in range(spb):
+            packed |= a[:, i] << numpy.uint8(bitdepth * (spb - 1 - i))
+        return packed.tostring()
+    s = _asbytes(samples)
+    s += strtobytes('\x00') * (-len(s) % spb)
+    n = len(s)
+    # With one sample per 8-bit lane, each step merges pairs of
+    # neighbouring lanes into a lane of twice the width, whose low byte
+    # holds the two samples next to each other; after log2(spb) steps
+    # the low byte of each lane is a packed byte.
+    x = _bytestoint(s)
+    width, bits = 8, bitdepth
+    while bits < 8:
+        low = _lanes(2 ** bits - 1, n * 4 // width, 2 * width)
+        x = (x & low) | ((x >> (width - bits)) & (low << bits))
+        width *= 2
+        bits *= 2
+    return _inttobytes(x, n)[spb - 1::spb]
+
+# 16-bit samples are converted to and from PNG's big-endian byte
+# order a whole row at a time, using an ``array('H')`` that is
+# byte swapped on little-endian hosts.
+_swap16 = sys.byteorder == 'little'
+
+def _tobigendian(samples):
+    """Convert a sequence of 16-bit samples to a string with the
+    samples in big-endian order."""
+
+    if isarray(samples) and samples.typecode == 'H':
+        a = samples[:]
+    else:
+        a = array('H', samples)
+    if _swap16:
+        a.byteswap()
+    return tostring(a)
+
+def _frombigendian(bytes):
+    """Inverse of :func:`_tobigendian`: convert a string or array of
+    bytes to an ``array('H')`` of samples."""
+
+    a = array('H', tostring(bytes) if isarray(bytes) else bytes)
+    if _swap16:
+        a.byteswap()
+    return a
+
+_unpack_tables = {}
+
+def _unpacksamples(bytes, bitdepth):
+    """Inverse of :func:`_packsamples`: unpack a sequence of bytes into
+    a string with one byte per sample, including any padding samples
+    at the end.
+    """
+
+    table = _unpack_tables.get(bitdepth)
+    if table is None:
+        # For each byte value, the string of the samples it holds.
+        spb = 8 // bitdepth
+        mask = 2 ** bitdepth - 1
+        shifts = [bitdepth * i for i in reversed(range(spb))]
+        table = _unpack_tables[bitdepth] = [
+          strtobytes(''.join(chr(mask & (o >> s)) for s in shifts))
+          for o in range(256)]
+    if isinstance(bytes, str):
+        bytes = array('B', bytes)
+    return strtobytes('').join(map(table.__getitem__, bytes))
+
+def _undo_up(result, previous, fu):
+    if numpy is not None:
+        # uint8 addition wraps around modulo 256, as the filter requires.
+        x = (numpy.frombuffer(tostring(result), numpy.uint8) +
+             numpy.frombuffer(tostring(previous), numpy.uint8))
+        result[:] = array('B', x.tostring())
+        return
+    n = len(result)
+    x = _laneadd(_bytestoint(tostring(result)),
+                 _bytestoint(tostring(previous)), n)
+    result[:] = array('B', _inttobytes(x, n))
+
+def _undo_sub(result, previous, fu):
+    if numpy is not None:
+        x = numpy.frombuffer(tostring(result), numpy.uint8).reshape(-1, fu)
+        result[:] = array('B', x.cumsum(axis=0, dtype=numpy.uint8).tostring())
+        return
+    # Each byte is the sum of itself and all the bytes at a multiple of
+    # `fu` to the left of it (modulo 256).  This prefix sum is computed
+    # in log2(n / fu) steps, each adding the partial sums `shift` bytes
+    # further to the left.
+    n = len(result)
+    x = _bytestoint(tostring(result))
+    shift = fu
+    while shift < n:
+        x = _laneadd(x, x >> (8 * shift), n)
+        shift *= 2
+    result[:] = array('B', _inttobytes(x, n))
+
+def _undo_average(result, previous, fu):
+    r = result.tolist()
+    p = previous.tolist()
+    for i in range(min(fu, len(r))):
+        r[i] = (r[i] + (p[i] >> 1)) & 0xff
+    for i in xrange(fu, len(r)):
+        r[i] = (r[i] + ((r[i - fu] + p[i]) >> 1)) & 0xff
+    result[:] = array('B', r)
+
+def _undo_paeth(result, previous, fu):
+    r = result.tolist()
+    p = previous.tolist()
+    for i in range(min(fu, len(r))):
+        # a and c are 0, so the predictor is b.
+        r[i] = (r[i] + p[i]) & 0xff
+    for i in xrange(fu, len(r)):
+        a = r[i - fu]
+        b = p[i]
+        c = p[i - fu]
+        pa = b - c
+        if pa < 0:
+            pa = -pa
+        pb = a - c
+        if pb < 0:
+            pb = -pb
+        pc = a + b - c - c
+        if pc < 0:
+            pc = -pc
+        if pa <= pb and pa <= pc:
+            r[i] = (r[i] + a) & 0xff
+        elif pb <= pc:
+            r[i] = (r[i] + b) & 0xff
+        else:
+            r[i] = (r[i] + c) & 0xff
+    result[:] = array('B', r)
+
+def _filter_numpy(type, line, fo, prev):
+    """Like :func:`_filter_bytes`, but using NumPy."""
+
+    x = numpy.frombuffer(line, numpy.uint8).astype(numpy.int16)
+    a = numpy.zeros_like(x)
+    a[fo:] = x[:-fo]
+    if type == 1:
+        out = x - a
+    else:
+        b = numpy.frombuffer(prev, numpy.uint8).astype(numpy.int16)
+        if type == 2:
+            out = x - b
+        elif type == 3:
+            out = x - ((a + b) >> 1)
+        else:
+            c = numpy.zeros_like(b)
+            c[fo:] = b[:-fo]
+            pa = numpy.abs(b - c)
+            pb = numpy.abs(a - c)
+            pc = numpy.abs(a + b - c - c)
+            out = x - numpy.where((pa <= pb) & (pa <= pc), a,
+                                  numpy.where(pb <= pc, b, c))
+    return (out & 0xff).astype(numpy.uint8).tostring()
+
+# Maps each filtered byte to its magnitude when interpreted as a signed
+# byte; used by the minimum sum of absolute differences heuristic.
+_filter_cost_table = ''.join(chr(min(x, 256 - x)) for x in range(256))
+
+def filter_scanline_adaptive(line, fo, prev=None):
+    """Filter a scanline with each of the five filter types and return
+    the result that has the lowest sum of absolute differences (with
+    each byte interpreted as a signed value), the heuristic suggested by
+    http://www.w3.org/TR/PNG/#12Filter-selection .  Arguments are as for
+    :meth:`filter_scanline`.
+    """
+
+    best = best_cost = None
+    for type in range(5):
+        out = filter_scanline(type, line, fo, prev)
+        cost = sum(array('B',
+                         tostring(out[1:]).translate(_filter_cost_table)))
+        if best_cost is None or cost < best_cost:
+            best, best_cost = out, cost
+    return best
+
 
 def from_array(a, mode=None, info=None):
     """Create a PNG :class:`Image` object from a 2- or 3-dimensional array.
@@ -1323,12 +2059,61 @@ class _readable(object):
         self.offset += n
         return r
 
+    def read_view(self, n):
+        """Like :meth:`read`, but return a buffer object that shares
+        its memory with the underlying data instead of a copy.
+        """
+
+        r = buffer(self.buf, min(self.offset, len(self.buf)), n)
+        self.offset += n
+        return r
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.offset
+        elif whence == 2:
+            offset += len(self.buf)
+        self.offset = max(0, offset)
+
+    def tell(self):
+        return self.offset
+
+class _mmapreadable(_readable):
+    """
+    A file-like interface for a memory mapped file.
+    """
+
+    def __init__(self, file):
+        _readable.__init__(self,
+          mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        self.file = file
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+def _openmapped(filename):
+    """Open the file `filename` for reading, memory mapped if possible.
+    """
+
+    file = open(filename, "rb")
+    try:
+        return _mmapreadable(file)
+    except (EnvironmentError, ValueError):
+        # Mapping fails for empty files (among others).
+        return file
+
 
 class Reader(object):
     """
     PNG decoder in pure Python.
     """
 
+    # Maximum number of bytes of pixel data decompressed at a time, see
+    # :meth:`read`.  Rounded down to a whole number of scanlines (but at
+    # least one scanline).
+    decompress_window = 2 ** 16
+
     def __init__(self, _guess=None, **kw):
         """
         Create a PNG decoder object.
@@ -1344,7 +2129,36 @@ class Reader(object):
         bytes
           ``array`` or ``string`` with PNG data.
 
+        The optional keyword argument `checksums` controls how the CRC
+        of each chunk is verified; it may be:
+
+        ``'strict'``
+          (the default) every chunk is verified as it is read;
+        ``'skip-idat'``
+          all chunks except ``IDAT`` chunks are verified, for trusted
+          input where the metadata is still worth checking;
+        ``'defer'``
+          nothing is verified as chunks are read, but the checks are
+          remembered and can be carried out later by calling
+          :meth:`verify_checksums`;
+        ``'skip'``
+          nothing is verified, for input that is already known to be
+          intact (for example because it came out of a zip file).
+
         """
+        checksums = kw.pop('checksums', 'strict')
+        if checksums not in ('strict', 'skip-idat', 'defer', 'skip'):
+            raise ValueError("checksums must be 'strict', 'skip-idat',"
+              " 'defer' or 'skip', not %r" % (checksums,))
+        self.checksums = checksums
+        # The (type, data, checksum) triples of chunks whose checksum
+        # has not been verified yet, when `checksums` is 'defer'.
+        self.pending_checksums = []
+        # File position of the first chunk, see validate_signature.
+        self.chunks_offset = None
+        # See index_chunks.
+        self.chunk_index = None
+
         if ((_guess is not None and len(kw) != 0) or
             (_guess is None and len(kw) != 1)):
             raise TypeError("Reader() takes exactly 1 argument")
@@ -1366,8 +2180,10 @@ class Reader(object):
             elif isinstance(_guess, file):
                 kw["file"] = _guess
 
+        # For filenames and bytes, ``IDAT`` chunk data is handed to zlib
+        # as a view on the data, without copying it; see :meth:`chunkdata`.
         if "filename" in kw:
-            self.file = open(kw["filename"], "rb")
+            self.file = _openmapped(kw["filename"])
         elif "file" in kw:
             self.file = kw["file"]
         elif "bytes" in kw:
@@ -1389,6 +2205,14 @@ class Reader(object):
         using `seek` can cause you to miss chunks.
         """
 
+        return self._chunk(seek)
+
+    def _chunk(self, seek=None, view=False):
+        """Like :meth:`chunk`; with `view` the data of ``IDAT`` chunks
+        may be a view, see :meth:`chunkdata`.  For the internal readers
+        that are done with the data before the next chunk is read.
+        """
+
         self.validate_signature()
 
         while True:
@@ -1397,33 +2221,133 @@ class Reader(object):
                 self.atchunk = self.chunklentype()
             length, type = self.atchunk
             self.atchunk = None
-            data = self.file.read(length)
-            if len(data) != length:
-                raise ChunkError('Chunk %s too short for required %i octets.'
-                  % (type, length))
-            checksum = self.file.read(4)
-            if len(checksum) != 4:
-                raise ValueError('Chunk %s too short for checksum.', checksum)
+            data, checksum = self.chunkdata(length, type, view)
             if seek and type != seek:
                 continue
-            verify = zlib.crc32(strtobytes(type))
-            verify = zlib.crc32(data, verify)
-            # Whether the output from zlib.crc32 is signed or not varies
-            # according to hideous implementation details, see
-            # http://bugs.python.org/issue1202 .
-            # We coerce it to be positive here (in a way which works on
-            # Python 2.3 and older).
-            verify &= 2 ** 32 - 1
-            verify = struct.pack('!I', verify)
-            if checksum != verify:
-                # print repr(checksum)
-                (a,) = struct.unpack('!I', checksum)
-                (b,) = struct.unpack('!I', verify)
-                raise ChunkError(
-                  "Checksum error in %s chunk: 0x%08X != 0x%08X." %
-                  (type, a, b))
+            self.checkchunk(type, data, checksum)
             return type, data
 
+    def chunkdata(self, length, type, view=False):
+        """Read the data and checksum of a chunk of type `type` whose
+        data is `length` bytes long, the file position being at the
+        start of the data; returns a (*data*, *checksum*) pair.  The
+        checksum is not verified, see :meth:`checkchunk`.
+
+        If `view` is true and the reader was given a filename or bytes,
+        the data of an ``IDAT`` chunk is returned as a ``buffer`` on the
+        input instead of a copy.  It is only valid while the file is
+        open.
+        """
+
+        if view and type == 'IDAT' and hasattr(self.file, 'read_view'):
+            data = self.file.read_view(length)
+        else:
+            data = self.file.read(length)
+        if len(data) != length:
+            raise ChunkError('Chunk %s too short for required %i octets.'
+              % (type, length))
+        checksum = self.file.read(4)
+        if len(checksum) != 4:
+            raise ChunkError('Chunk %s too short for checksum.' % type)
+        return data, checksum
+
+    def checkchunk(self, type, data, checksum):
+        """Verify, skip or defer the checksum of a chunk as determined
+        by the `checksums` argument of the constructor.
+        """
+
+        mode = self.checksums
+        if mode == 'strict' or (mode == 'skip-idat' and type != 'IDAT'):
+            _checkchunk(type, data, checksum)
+        elif mode == 'defer':
+            self.pending_checksums.append((type, data, checksum))
+
+    def index_chunks(self):
+        """Build an index of all the chunks in the file, without
+        reading their data; returns a list of (*type*, *offset*,
+        *length*) triples, in file order.  *offset* is the file position
+        of the chunk's data (the 4 byte length and 4 byte type precede
+        it, the 4 byte checksum follows it), *length* is the length of
+        its data.
+
+        Only the chunk headers are read; the file position is moved
+        past the data of each chunk with ``seek``, so the input must be
+        seekable.  Afterwards the file position is restored, so this
+        can be mixed with the other reading methods.  The index is kept
+        in the ``chunk_index`` attribute, and is used by
+        :meth:`read_indexed`.
+        """
+
+        if self.chunk_index is not None:
+            return self.chunk_index
+        self.validate_signature()
+        if self.chunks_offset is None:
+            raise Error("cannot index the chunks of a file that is"
+              " not seekable")
+        position = self.file.tell()
+        self.file.seek(self.chunks_offset)
+        index = []
+        try:
+            while True:
+                x = self.file.read(8)
+                if not x:
+                    break
+                if len(x) != 8:
+                    raise FormatError(
+                      'End of file whilst reading chunk length and type.')
+                length, type = struct.unpack('!I4s', x)
+                type = bytestostr(type)
+                if length > 2 ** 31 - 1:
+                    raise FormatError('Chunk %s is too large: %d.'
+                      % (type, length))
+                index.append((type, self.file.tell(), length))
+                if type == 'IEND':
+                    break
+                self.file.seek(length + 4, 1)
+        finally:
+            self.file.seek(position)
+        self.chunk_index = index
+        return index
+
+    def read_indexed(self, type, which=0):
+        """Read the data of a chunk of type `type` directly, using the
+        index built by :meth:`index_chunks`.  `which` selects among the
+        chunks of that type like a list index: 0 is the first one, -1
+        the last one.  The checksum is handled as for :meth:`chunk`.
+        The file position is left unchanged.
+
+        Raises :exc:`KeyError` if there is no such chunk.
+        """
+
+        entries = [entry for entry in self.index_chunks() if entry[0] == type]
+        try:
+            type, offset, length = entries[which]
+        except IndexError:
+            raise KeyError("No %s chunk number %d." % (type, which))
+        position = self.file.tell()
+        try:
+            self.file.seek(offset)
+            data, checksum = self.chunkdata(length, type)
+        finally:
+            self.file.seek(position)
+        self.checkchunk(type, data, checksum)
+        return data
+
+    def verify_checksums(self):
+        """Verify the checksums of the chunks read so far whose check
+        was deferred (see the `checksums` argument of the constructor),
+        raising :exc:`ChunkError` for the first one that is wrong.
+
+        With deferred checking the ``IDAT`` data of a file opened by
+        name may be a view on the mapped file, so this must be called
+        before the file is closed.
+        """
+
+        pending = self.pending_checksums
+        self.pending_checksums = []
+        for type, data, checksum in pending:
+            _checkchunk(type, data, checksum)
+
     def chunks(self):
         """Return an iterator that will yield each chunk as a
         (*chunktype*, *content*) pair.
@@ -1450,19 +2374,26 @@ class Reader(object):
         result will be returned as a fresh sequence of bytes.
         """
 
-        # :todo: Would it be better to update scanline in place?
-
         # Create the result byte array.  It seems that the best way to
         # create the array to be the right size is to copy from an
         # existing sequence.  *sigh*
-        # If we fill the result with scanline, then this allows a
-        # micro-optimisation in the "null" and "sub" cases.
-        result = array('B', scanline)
+        # Constructing an array from another array goes element by
+        # element, slicing it is a plain copy.
+        if isarray(scanline) and scanline.typecode == 'B':
+            result = scanline[:]
+        else:
+            result = array('B', scanline)
+        self.undo_filter_inplace(filter_type, result, previous)
+        return result
+
+    def undo_filter_inplace(self, filter_type, scanline, previous):
+        """Like :meth:`undo_filter`, but the filter is undone in
+        `scanline` itself, which must be an ``array('B')``.  Nothing is
+        returned.
+        """
 
         if filter_type == 0:
-            # And here, we _rely_ on filling the result with scanline,
-            # above.
-            return result
+            return
 
         if filter_type not in (1, 2, 3, 4):
             raise FormatError('Invalid PNG Filter Type.'
@@ -1474,78 +2405,20 @@ class Reader(object):
         # byte is used instead.
         fu = max(1, self.psize)
 
-        # For the first line of a pass, synthesize a dummy previous
-        # line.  An alternative approach would be to observe that on the
-        # first line 'up' is the same as 'null', 'paeth' is the same
-        # as 'sub', with only 'average' requiring any special case.
+        # For the first line of a pass, observe that 'up' is the same as
+        # 'null', 'paeth' is the same as 'sub', with only 'average'
+        # requiring a dummy previous line.
         if not previous:
-            previous = array('B', [0] * len(scanline))
-
-        def sub():
-            """Undo sub filter."""
-
-            ai = 0
-            # Loops starts at index fu.  Observe that the initial part
-            # of the result is already filled in correctly with
-            # scanline.
-            for i in range(fu, len(result)):
-                x = scanline[i]
-                a = result[ai]
-                result[i] = (x + a) & 0xff
-                ai += 1
-
-        def up():
-            """Undo up filter."""
-
-            for i in range(len(result)):
-                x = scanline[i]
-                b = previous[i]
-                result[i] = (x + b) & 0xff
-
-        def average():
-            """Undo average filter."""
-
-            ai = -fu
-            for i in range(len(result)):
-                x = scanline[i]
-                if ai < 0:
-                    a = 0
-                else:
-                    a = result[ai]
-                b = previous[i]
-                result[i] = (x + ((a + b) >> 1)) & 0xff
-                ai += 1
-
-        def paeth():
-            """Undo Paeth filter."""
-
-            # Also used for ci.
-            ai = -fu
-            for i in range(len(result)):
-                x = scanline[i]
-                if ai < 0:
-                    a = c = 0
-                else:
-                    a = result[ai]
-                    c = previous[ai]
-                b = previous[i]
-                p = a + b - c
-                pa = abs(p - a)
-                pb = abs(p - b)
-                pc = abs(p - c)
-                if pa <= pb and pa <= pc:
-                    pr = a
-                elif pb <= pc:
-                    pr = b
-                else:
-                    pr = c
-                result[i] = (x + pr) & 0xff
-                ai += 1
+            if filter_type == 2:
+                return
+            if filter_type == 4:
+                filter_type = 1
+            previous = array('B', [0]) * len(scanline)
 
         # Call appropriate filter algorithm.  Note that 0 has already
         # been dealt with.
-        (None, sub, up, average, paeth)[filter_type]()
-        return result
+        (None, _undo_sub, _undo_up, _undo_average,
+         _undo_paeth)[filter_type](scanline, previous, fu)
 
     def deinterlace(self, raw):
         """
@@ -1570,22 +2443,27 @@ class Reader(object):
             #     xstart, ystart, xstep, ystep)
             if xstart >= self.width:
                 continue
-            # The previous (reconstructed) scanline.  None at the
-            # beginning of a pass to indicate that there is no previous
-            # line.
-            recon = None
             # Pixels per row (reduced pass image)
             ppr = int(math.ceil((self.width - xstart) / float(xstep)))
             # Row size in bytes for this pass.
             row_size = int(math.ceil(self.psize * ppr))
+            # The scanlines of a pass are reconstructed in two buffers
+            # that take turns: the current scanline, and the previous
+            # (reconstructed) scanline.  The latter is None at the
+            # beginning of a pass to indicate that there is no previous
+            # line.
+            recon = array('B', [0]) * row_size
+            previous = None
+            spare = array('B', [0]) * row_size
             for y in range(ystart, self.height, ystep):
                 filter_type = raw[source_offset]
                 source_offset += 1
-                scanline = raw[source_offset:source_offset + row_size]
+                recon[:] = raw[source_offset:source_offset + row_size]
                 source_offset += row_size
-                recon = self.undo_filter(filter_type, scanline, recon)
+                self.undo_filter_inplace(filter_type, recon, previous)
+                previous, recon = recon, previous or spare
                 # Convert so that there is one element per pixel value
-                flat = self.serialtoflat(recon, ppr)
+                flat = self.serialtoflat(previous, ppr)
                 if xstep == 1:
                     azzert(xstart == 0)
                     offset = y * vpr
@@ -1612,18 +2490,11 @@ class Reader(object):
             if self.bitdepth == 8:
                 return raw
             if self.bitdepth == 16:
-                raw = tostring(raw)
-                return array('H', struct.unpack('!%dH' % (len(raw) // 2), raw))
+                return _frombigendian(raw)
             azzert(self.bitdepth < 8)
-            width = self.width
-            # Samples per byte
-            spb = 8 // self.bitdepth
-            out = array('B')
-            mask = 2 ** self.bitdepth - 1
-            shifts = map(self.bitdepth.__mul__, reversed(range(spb)))
-            for o in raw:
-                out.extend(map(lambda i: mask & (o >> i), shifts))
-            return out[:width]
+            out = array('B', _unpacksamples(raw, self.bitdepth))
+            del out[self.width:]
+            return out
 
         return itertools.imap(asvalues, rows)
 
@@ -1635,45 +2506,64 @@ class Reader(object):
         if self.bitdepth == 8:
             return bytes
         if self.bitdepth == 16:
-            bytes = tostring(bytes)
-            return array('H',
-              struct.unpack('!%dH' % (len(bytes) // 2), bytes))
+            return _frombigendian(bytes)
         azzert(self.bitdepth < 8)
         if width is None:
             width = self.width
         # Samples per byte
         spb = 8 // self.bitdepth
-        out = array('B')
-        mask = 2 ** self.bitdepth - 1
-        shifts = map(self.bitdepth.__mul__, reversed(range(spb)))
-        l = width
-        for o in bytes:
-            out.extend([(mask & (o >> s)) for s in shifts][:l])
-            l -= spb
-            if l <= 0:
-                l = width
+        out = array('B', _unpacksamples(bytes, self.bitdepth))
+        # Each row is padded to a whole number of bytes; remove the
+        # padding samples.
+        row = -(-width // spb) * spb
+        if row != width:
+            rows = out
+            out = array('B')
+            for i in range(0, len(rows), row):
+                out.extend(rows[i:i + width])
         return out
 
-    def iterstraight(self, raw):
+    def iterstraight(self, raw, reuse_rows=False):
         """Iterator that undoes the effect of filtering, and yields each
         row in serialised format (as a sequence of bytes).  Assumes input
         is straightlaced.  `raw` should be an iterable that yields the
-        raw bytes in chunks of arbitrary size."""
+        raw bytes in chunks of arbitrary size.
+
+        Rows are reconstructed in place, in two buffers that take turns.
+        Normally a copy of each row is yielded; when `reuse_rows` is
+        true the buffers themselves are yielded instead, so each row is
+        only valid until the next one is requested.
+        """
 
         # length of row, in bytes
         rb = self.row_bytes
         a = array('B')
+        # Offset in `a` of the next filter type byte.  Consumed bytes are
+        # only removed from `a` once all complete rows in it have been
+        # processed, rather than once per row.
+        offset = 0
+        recon = array('B', [0]) * rb
         # The previous (reconstructed) scanline.  None indicates first
         # line of image.
-        recon = None
+        previous = None
+        spare = array('B', [0]) * rb
         for some in raw:
-            a.extend(some)
-            while len(a) >= rb + 1:
-                filter_type = a[0]
-                scanline = a[1:rb + 1]
-                del a[:rb + 1]
-                recon = self.undo_filter(filter_type, scanline, recon)
-                yield recon
+            if isinstance(some, str):
+                a.fromstring(some)
+            else:
+                a.extend(some)
+            while len(a) - offset >= rb + 1:
+                filter_type = a[offset]
+                recon[:] = a[offset + 1:offset + rb + 1]
+                offset += rb + 1
+                self.undo_filter_inplace(filter_type, recon, previous)
+                if reuse_rows:
+                    yield recon
+                else:
+                    yield recon[:]
+                previous, recon = recon, previous or spare
+            del a[:offset]
+            offset = 0
         if len(a) != 0:
             # :file:format We get here with a file format error: when the
             # available bytes (after decompressing) do not pack into exact
@@ -1692,6 +2582,11 @@ class Reader(object):
         self.signature = self.file.read(8)
         if self.signature != _signature:
             raise FormatError("PNG file has invalid signature.")
+        # Remember where the chunks start, for :meth:`index_chunks`.
+        try:
+            self.chunks_offset = self.file.tell()
+        except (AttributeError, EnvironmentError):
+            self.chunks_offset = None
 
     def preamble(self):
         """
@@ -1853,7 +2748,7 @@ class Reader(object):
                 not self.colormap and len(data) != self.planes):
                 raise FormatError("sBIT chunk has incorrect length.")
 
-    def read(self):
+    def read(self, reuse_rows=False):
         """
         Read the PNG file and decode it.  Returns (`width`, `height`,
         `pixels`, `metadata`).
@@ -1861,13 +2756,19 @@ class Reader(object):
         May use excessive memory.
 
         `pixels` are returned in boxed row flat pixel format.
+
+        If `reuse_rows` is true then, for straightlaced images, the rows
+        may share their storage: each row is then only valid until the
+        next row is requested (see :meth:`iterstraight`).  This saves an
+        allocation per row for callers that consume each row straight
+        away.
         """
 
         def iteridat():
             """Iterator that yields all the ``IDAT`` chunks as strings."""
             while True:
                 try:
-                    type, data = self.chunk()
+                    type, data = self._chunk(view=True)
                 except ValueError, e:
                     raise ChunkError(e.args[0])
                 if type == 'IEND':
@@ -1884,32 +2785,41 @@ class Reader(object):
         def iterdecomp(idat):
             """Iterator that yields decompressed strings.  `idat` should
             be an iterator that yields the ``IDAT`` chunk data.
+
+            However large the ``IDAT`` chunks are, each string is at most
+            one window long; the window is a whole number of scanlines.
             """
 
-            # Currently, with no max_length paramter to decompress, this
-            # routine will do one yield per IDAT chunk.  So not very
-            # incremental.
+            # Scanline size in bytes, including the filter type byte.
+            # (For interlaced images this is the largest scanline.)
+            line = self.row_bytes + 1
+            window = line * max(1, self.decompress_window // line)
             d = zlib.decompressobj()
-            # Each IDAT chunk is passed to the decompressor, then any
-            # remaining state is decompressed out.
+            # Each IDAT chunk is passed to the decompressor, limiting the
+            # output size; input that the decompressor could not use yet
+            # is passed in again.  Finally any remaining state is
+            # decompressed out.
             for data in idat:
-                # :todo: add a max_length argument here to limit output
-                # size.
-                yield array('B', d.decompress(data))
-            yield array('B', d.flush())
+                while data:
+                    yield d.decompress(data, window)
+                    data = d.unconsumed_tail
+            yield d.flush()
 
         self.preamble()
         raw = iterdecomp(iteridat())
 
         if self.interlace:
-            raw = array('B', itertools.chain(*raw))
+            data = array('B')
+            for some in raw:
+                data.fromstring(some)
+            raw = data
             arraycode = 'BH'[self.bitdepth > 8]
             # Like :meth:`group` but producing an array.array object for
             # each row.
             pixels = itertools.imap(lambda * row: array(arraycode, row),
                        *[iter(self.deinterlace(raw))] * self.width * self.planes)
         else:
-            pixels = self.iterboxed(self.iterstraight(raw))
+            pixels = self.iterboxed(self.iterstraight(raw, reuse_rows))
         meta = dict()
         for attr in 'greyscale alpha planes bitdepth interlace'.split():
             meta[attr] = getattr(self, attr)
@@ -1934,9 +2844,11 @@ class Reader(object):
         more stream-friendly boxed row flat pixel format.
         """
 
-        x, y, pixel, meta = self.read()
+        x, y, rows, meta = self.read(reuse_rows=True)
         arraycode = 'BH'[meta['bitdepth'] > 8]
-        pixel = array(arraycode, itertools.chain(*pixel))
+        pixel = array(arraycode)
+        for row in rows:
+            pixel.extend(row)
         return x, y, pixel, meta
 
     def palette(self, alpha='natural'):
@@ -2207,3 +3119,170 @@ class Reader(object):
         return width, height, convert(), meta
 
 
+    def header(self, palette=False):
+        """Read just the start of the PNG file and return a dictionary
+        describing the image, without reading or decompressing any
+        pixel data.
+
+        The dictionary has the same keys as the *metadata* returned by
+        :meth:`read` (``size``, ``greyscale``, ``alpha``, ``planes``,
+        ``bitdepth``, ``interlace``) plus ``width``, ``height`` and
+        ``color_type``.  Only the ``IHDR`` chunk is read, unless
+        `palette` is true: then all the chunks up to the first ``IDAT``
+        chunk are read as per :meth:`preamble` and, for colour mapped
+        images, a ``palette`` entry (see :meth:`palette`) is added, as
+        are ``gamma``, ``transparent`` and ``background`` when present.
+        """
+
+        self.validate_signature()
+        if not self.atchunk:
+            self.atchunk = self.chunklentype()
+        if self.atchunk is None or self.atchunk[1] != 'IHDR':
+            raise FormatError('IHDR chunk is not the first chunk.')
+        self.process_chunk()
+        meta = dict(width=self.width, height=self.height,
+                    size=(self.width, self.height),
+                    color_type=self.color_type)
+        for attr in 'greyscale alpha planes bitdepth interlace'.split():
+            meta[attr] = getattr(self, attr)
+        if palette:
+            self.preamble()
+            if self.colormap:
+                meta['palette'] = self.palette()
+            for attr in 'gamma transparent background'.split():
+                a = getattr(self, attr, None)
+                if a is not None:
+                    meta[attr] = a
+        return meta
+
+    def verify(self, max_pixels=None):
+        """Check the whole PNG file for corruption, without decoding
+        the pixels.  Returns the image description, as per
+        :meth:`header`, if the file is intact; otherwise raises
+        :exc:`FormatError` (or its subclass :exc:`ChunkError`) saying
+        what is wrong.
+
+        The signature, the checksum of every chunk, the ``IHDR`` chunk
+        and the chunk ordering constraints checked by :meth:`preamble`
+        are verified; the ``IDAT`` chunks must be consecutive and hold a
+        single, complete zlib stream (including its checksum) that
+        decompresses to exactly the number of bytes that the image
+        dimensions require; and the file must end with an ``IEND``
+        chunk.  If `max_pixels` is given, images with more pixels than
+        that are rejected before any decompression takes place.
+
+        Checksums are verified whatever the `checksums` argument of the
+        constructor was; the checking mode is restored afterwards.
+        """
+
+        checksums = self.checksums
+        self.checksums = 'strict'
+        try:
+            return self._verify(max_pixels)
+        finally:
+            self.checksums = checksums
+
+    def _verify(self, max_pixels):
+        """The work of :meth:`verify`, with strict checksums."""
+
+        self.verify_checksums()
+        try:
+            meta = self.header()
+            if (max_pixels is not None and
+                self.width * self.height > max_pixels):
+                raise FormatError('Image is too large: %dx%d pixels.'
+                  % (self.width, self.height))
+            self.preamble()
+        except ValueError, e:
+            raise ChunkError(str(e))
+
+        # Size of the decompressed data, including the filter type byte
+        # of each scanline.
+        if self.interlace:
+            passes = []
+            for xstart, ystart, xstep, ystep in _adam7:
+                ppr = int(math.ceil((self.width - xstart) / float(xstep)))
+                rows = int(math.ceil((self.height - ystart) / float(ystep)))
+                if ppr > 0:
+                    passes.append((ppr, rows))
+        else:
+            passes = [(self.width, self.height)]
+        expected = 0
+        for ppr, rows in passes:
+            expected += max(0, rows) * (int(math.ceil(ppr * self.psize)) + 1)
+
+        line = self.row_bytes + 1
+        window = line * max(1, self.decompress_window // line)
+        d = zlib.decompressobj()
+        size = 0
+        idat = None
+        try:
+            while True:
+                if not self.atchunk:
+                    self.atchunk = self.chunklentype()
+                    if self.atchunk is None:
+                        raise FormatError('File ends without an IEND chunk.')
+                try:
+                    type, data = self._chunk(view=True)
+                except ValueError, e:
+                    raise ChunkError(e.args[0])
+                if type == 'IEND':
+                    break
+                if type != 'IDAT':
+                    if idat:
+                        idat = False
+                    continue
+                if idat is False:
+                    raise FormatError('IDAT chunks are not consecutive.')
+                idat = True
+                while data:
+                    size += len(d.decompress(data, window))
+                    if size > expected:
+                        raise FormatError(
+                          'Decompressed IDAT data is too long.')
+                    data = d.unconsumed_tail
+            # Drain any output still held back by the window.
+            while True:
+                out = d.decompress(strtobytes(''), window)
+                if not out:
+                    break
+                size += len(out)
+                if size > expected:
+                    raise FormatError('Decompressed IDAT data is too long.')
+            # A decompressor that has seen the end of the stream passes
+            # any further input through to unused_data; one that has not
+            # (the stream is truncated) consumes it.
+            if d.unused_data:
+                raise FormatError('IDAT chunks have data after the zlib stream.')
+            d.decompress(strtobytes('\x00'))
+            if not d.unused_data:
+                raise FormatError('IDAT zlib stream is truncated.')
+        except zlib.error, e:
+            raise FormatError('IDAT zlib stream is corrupt: %s' % e)
+        if size != expected:
+            raise FormatError('Wrong size for decompressed IDAT data:'
+              ' %d instead of %d.' % (size, expected))
+        return meta
+
+def probe(_guess=None, palette=False, **kw):
+    """Return the image description of a PNG file, as per
+    :meth:`Reader.header`, without decoding it.
+
+    The input (and `checksums`) is specified as for the :class:`Reader`
+    constructor.  A file named by `filename` is opened (without memory
+    mapping it, as only its first few hundred bytes are read) and
+    closed again; a file object passed as `file` is left open,
+    positioned after the chunks that were read.
+    """
+
+    checksums = kw.pop('checksums', 'strict')
+    if _guess is not None and isinstance(_guess, str):
+        kw["filename"] = _guess
+        _guess = None
+    if _guess is None and "filename" in kw and len(kw) == 1:
+        f = open(kw["filename"], "rb")
+        try:
+            return Reader(file=f, checksums=checksums).header(palette)
+        finally:
+            f.close()
+    return Reader(_guess, checksums=checksums, **kw).header(palette)
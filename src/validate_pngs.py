@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.6@@
+
+"""Validates all PNG files below a directory and prints a JSON report.
+
+Exits with status 1 when at least one file is invalid, so it can be used as the first stage of a build.
+"""
+
+import argparse
+import json
+import sys
+
+from app_utils import validate_png_tree
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('root', help='directory to validate')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--max-pixels', type=int, default=None, help='reject images with more pixels')
+    parser.add_argument('--max-file-size', type=int, default=None, help='reject files with more bytes')
+    parser.add_argument('-o', '--output', default=None, help='write the report to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = validate_png_tree(args.root, args.processes, args.max_pixels, args.max_file_size)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    for result in report['files']:
+        if result['error']:
+            print >> sys.stderr, '%s: %s' % (result['path'], result['error'])
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())